@@ -37,12 +37,15 @@ setup(
             'keyframed',
             'numpy',
             'opencv-python-headless',
+            'simplejpeg',
         ],
         'anim_ui': [
             'keyframed',
             'gradio',
             'numpy',
             'opencv-python-headless',
+            'orjson',
+            'simplejpeg',
             'tqdm',
         ]
     },
@@ -1,6 +1,5 @@
 import base64
 import bisect
-import cv2
 import glob
 import json
 import logging
@@ -12,16 +11,18 @@ import random
 import shutil
 
 from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, fields
 from keyframed.dsl import curve_from_cn_string
 from PIL import Image, ImageOps
 from types import SimpleNamespace
-from typing import Callable, cast, Deque, Dict, Generator, List, Optional, Tuple, Union
+from typing import Callable, cast, Deque, Dict, Generator, List, Optional, Tuple, Union, TYPE_CHECKING
 
 from stability_sdk.api import Context, generation
 from stability_sdk.utils import (
+    PNG_COMPRESS_LEVEL,
+    TransformOpBuilder,
     camera_pose_transform,
-    color_adjust_transform,
     depth_calc_transform,
     guidance_from_string,
     image_mix,
@@ -32,12 +33,18 @@ from stability_sdk.utils import (
 )
 import stability_sdk.matrix as matrix
 
+if TYPE_CHECKING:
+    import cv2  # imported lazily at runtime, only video input and mask blurring need it
+
 logger = logging.getLogger(__name__)
 logger.setLevel(level=logging.INFO)
 
 DEFAULT_MODEL = 'stable-diffusion-v1-5'
 TRANSLATION_SCALE = 1.0/200.0 # matches Disco and Deforum
 
+# frame, mask and depth map writes are I/O bound and overlap with API requests
+_save_executor = ThreadPoolExecutor(max_workers=3)
+
 docstring_bordermode = ( 
     "Method that will be used to fill empty regions, e.g. after a rotation transform."
     "\n\t* reflect - Mirror pixels across the image edge to fill empty regions."
@@ -217,7 +224,9 @@ def args_to_dict(args):
 
 def cv2_to_pil(cv2_img: np.ndarray) -> Image.Image:
     """Convert a cv2 BGR ndarray to a PIL Image"""
-    return Image.fromarray(cv2_img[:, :, ::-1])
+    import cv2
+    # cvtColor writes a contiguous RGB buffer in one pass, a reversed channel view would be copied again
+    return Image.fromarray(cv2.cvtColor(cv2_img, cv2.COLOR_BGR2RGB))
 
 def interpolate_frames(
     context: Context, 
@@ -236,20 +245,40 @@ def interpolate_frames(
     # perform frame interpolation
     os.makedirs(out_path, exist_ok=True)
     ratios = np.linspace(0, 1, interp_factor+1)[1:-1].tolist()
+    frame1 = Image.open(frame_files[0]) if frame_files else None
     for i in range(len(frame_files) - 1):
-        shutil.copy(frame_files[i], os.path.join(out_path, f"frame_{i * interp_factor:05d}.png"))
-        frame1 = Image.open(frame_files[i])
+        link_or_copy(frame_files[i], os.path.join(out_path, f"frame_{i * interp_factor:05d}.png"))
         frame2 = Image.open(frame_files[i + 1])
         yield frame1
         tweens = context.interpolate([frame1, frame2], ratios, interp_mode)
         for ti, tween in enumerate(tweens):
-            tween.save(os.path.join(out_path, f"frame_{i * interp_factor + ti + 1:05d}.png"))
+            # save then swap in, so a key frame hardlink left here by an earlier run isn't written through
+            tween_path = os.path.join(out_path, f"frame_{i * interp_factor + ti + 1:05d}.png")
+            tween.save(tween_path + ".tmp", format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+            os.replace(tween_path + ".tmp", tween_path)
             yield tween
+        frame1 = frame2     # already decoded, becomes the start of the next pair
 
     # copy final frame
-    shutil.copy(frame_files[-1], os.path.join(out_path, f"frame_{(len(frame_files)-1) * interp_factor:05d}.png"))        
+    link_or_copy(frame_files[-1], os.path.join(out_path, f"frame_{(len(frame_files)-1) * interp_factor:05d}.png"))        
+
+def link_or_copy(src: str, dst: str):
+    """Hardlinks src to dst when both are on the same filesystem, otherwise copies the file contents."""
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    # link under a temporary name and swap it in, so an existing dst is only replaced once the link exists
+    tmp = dst + ".tmp"
+    try:
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.link(src, tmp)
+    except OSError:
+        shutil.copyfile(src, dst)
+    else:
+        os.replace(tmp, dst)
 
 def mask_erode_blur(mask: Image.Image, mask_erode: int, mask_blur: int) -> Image.Image:
+    import cv2
     mask = np.array(mask)
     if mask_erode > 0:
         ks = mask_erode*2 + 1
@@ -313,7 +342,9 @@ class Animator:
         self.args = args or AnimationArgs()
         self.color_match_images: Optional[Dict[int, Image.Image]] = {}
         self.diffusion_cadence_ofs: int = 0
+        self.cadence_interp_mode: generation.InterpolateMode
         self.frame_args: FrameArgs
+        self.guidance_preset: generation.GuidancePreset
         self.inpaint_mask: Optional[Image.Image] = None
         self.key_frame_values: List[int] = []
         self.out_dir: Optional[str] = out_dir
@@ -323,11 +354,14 @@ class Animator:
         self.prior_frames: Deque[Image.Image] = deque([], 1)    # forward warped prior frames. stores one image with cadence off, two images otherwise
         self.prior_diffused: Deque[Image.Image] = deque([], 1)  # results of diffusion. stores one image with cadence off, two images otherwise
         self.prior_xforms: Deque[matrix.Matrix] = deque([], 1)   # accumulated transforms since last diffusion. stores one with cadence off, two otherwise
+        self.sampler: generation.DiffusionSampler
         self.negative_prompt: str = negative_prompt
         self.negative_prompt_weight: float = negative_prompt_weight
+        self.op_builder = TransformOpBuilder()                  # per frame init ops are rebuilt in place
         self.start_frame_idx: int = 0
         self.video_prev_frame: Optional[Image.Image] = None
-        self.video_reader: Optional[cv2.VideoCapture] = None
+        self.video_prev_frame_b64: Optional[str] = None         # base64 PNG of video_prev_frame, reused as the next warp_flow prev_frame
+        self.video_reader: Optional["cv2.VideoCapture"] = None
 
         # configure Api to retry on classifier obfuscations
         self.api._retry_obfuscation = True
@@ -373,14 +407,18 @@ class Animator:
             return matrix.identity
 
     def emit_frame(self, frame_idx: int, out_frame: Image.Image) -> Image.Image:
-        if self.args.save_depth_maps:
-            depth_image = self.generate_depth_image(out_frame)
-            self.save_to_out_dir(frame_idx, depth_image, prefix='depth')
+        saves = [_save_executor.submit(self.save_to_out_dir, frame_idx, out_frame)]
 
         if self.args.save_inpaint_masks and self.inpaint_mask is not None:
-            self.save_to_out_dir(frame_idx, self.inpaint_mask, prefix='mask')
+            saves.append(_save_executor.submit(self.save_to_out_dir, frame_idx, self.inpaint_mask, prefix='mask'))
 
-        self.save_to_out_dir(frame_idx, out_frame)
+        if self.args.save_depth_maps:
+            depth_image = self.generate_depth_image(out_frame)
+            saves.append(_save_executor.submit(self.save_to_out_dir, frame_idx, depth_image, prefix='depth'))
+
+        # frames must be on disk before returning, resuming and video creation read them back
+        for save in saves:
+            save.result()
         return out_frame
 
     def generate_depth_image(self, image: Image.Image) -> Image.Image:
@@ -464,8 +502,6 @@ class Animator:
     ) -> Image.Image:
         args = self.args
         steps = int(self.frame_args.steps_curve[frame_idx])
-        sampler = sampler_from_string(args.sampler.lower())
-        guidance = guidance_from_string(args.clip_guidance)
 
         # fetch set of prompts and weights for this frame
         prompts, weights = self.get_animation_prompts_weights(frame_idx)
@@ -482,10 +518,10 @@ class Animator:
                 steps=steps,
                 seed=seed if seed is not None else args.seed,
                 cfg_scale=args.cfg_scale,
-                sampler=sampler, 
+                sampler=self.sampler, 
                 init_strength=0.0,
                 masked_area_init=generation.MASKED_AREA_INIT_ZERO,
-                guidance_preset=guidance,
+                guidance_preset=self.guidance_preset,
                 preset=args.preset,
             )
         else:
@@ -500,13 +536,13 @@ class Animator:
                 steps=adjusted_steps,
                 seed=seed if seed is not None else args.seed,
                 cfg_scale=args.cfg_scale,
-                sampler=sampler,
+                sampler=self.sampler,
                 init_image=image,
                 init_strength=mask_min_value,
                 init_noise_scale=noise_scale,
                 mask=binary_mask,
                 masked_area_init=generation.MASKED_AREA_INIT_ORIGINAL,
-                guidance_preset=guidance,
+                guidance_preset=self.guidance_preset,
                 preset=args.preset,
             )
         return results[generation.ARTIFACT_IMAGE][0]
@@ -533,6 +569,7 @@ class Animator:
 
         # try to load mask as a video
         if self.mask is None:
+            import cv2
             self.mask_reader = cv2.VideoCapture(self.args.mask_path)
             self.next_mask()
 
@@ -543,6 +580,7 @@ class Animator:
         if self.args.animation_mode != 'Video Input' or not self.args.video_init_path:
             return
 
+        import cv2
         self.video_reader = cv2.VideoCapture(self.args.video_init_path)
         if self.video_reader is not None:
             success, image = self.video_reader.read()
@@ -556,10 +594,13 @@ class Animator:
         if not self.mask_reader:
             return False
 
-        for _ in range(self.args.extract_nth_frame):
-            success, mask = self.mask_reader.read()
-            if not success:
+        # skipped frames are only grabbed, not retrieved and converted
+        for _ in range(self.args.extract_nth_frame - 1):
+            if not self.mask_reader.grab():
                 return
+        success, mask = self.mask_reader.read()
+        if not success:
+            return
 
         self.set_mask(cv2_to_pil(mask))
 
@@ -586,7 +627,7 @@ class Animator:
         init_ops: List[generation.TransformParameters] = []
 
         if do_color_match or do_bchsl or do_noise:
-            init_ops.append(color_adjust_transform(
+            init_ops.append(self.op_builder.color_adjust(
                 brightness=brightness,
                 contrast=contrast,
                 hue=hue,
@@ -698,8 +739,6 @@ class Animator:
                         min_val=mask_min_value)
 
                 # generate the next frame
-                sampler = sampler_from_string(args.sampler.lower())
-                guidance = guidance_from_string(args.clip_guidance)
                 noise_scale = self.frame_args.noise_scale_curve[frame_idx]
                 adjusted_steps = int(max(5, steps*(1.0-init_strength))) if args.steps_strength_adj else int(steps)
                 generate_request = self.api.generate(
@@ -708,14 +747,14 @@ class Animator:
                     steps=adjusted_steps,
                     seed=seed,
                     cfg_scale=args.cfg_scale,
-                    sampler=sampler, 
+                    sampler=self.sampler, 
                     init_image=init_image if init_image_ops is None else None, 
                     init_strength=init_strength,
                     init_noise_scale=noise_scale, 
                     init_depth=init_depth,
                     mask = self.inpaint_mask if do_inpainting else self.mask,
                     masked_area_init=generation.MASKED_AREA_INIT_ORIGINAL,
-                    guidance_preset=guidance,
+                    guidance_preset=self.guidance_preset,
                     preset=args.preset,
                     return_request=True
                 )
@@ -740,7 +779,7 @@ class Animator:
                 out_frame = self.api.interpolate(
                     [self.prior_frames[0], self.prior_frames[1]],
                     [tween],
-                    interpolate_mode_from_string(args.cadence_interp)
+                    self.cadence_interp_mode
                 )[0]
 
             # save and return final frame
@@ -762,7 +801,7 @@ class Animator:
 
     def save_to_out_dir(self, frame_idx: int, image: Image.Image, prefix: str = "frame"):
         if self.out_dir is not None:
-            image.save(self.get_frame_filename(frame_idx, prefix=prefix))
+            image.save(self.get_frame_filename(frame_idx, prefix=prefix), compress_level=PNG_COMPRESS_LEVEL)
 
     def set_mask(self, mask: Image.Image):
         self.mask = mask.convert('L').resize((self.args.width, self.args.height), resample=Image.LANCZOS)
@@ -828,6 +867,11 @@ class Animator:
                 logger.warning(f"CLIP guidance is not supported by {unsupported}, disabling guidance.")
                 args.clip_guidance = 'None'
 
+        # resolve enum settings once rather than on every frame
+        self.sampler = sampler_from_string(args.sampler.lower())
+        self.guidance_preset = guidance_from_string(args.clip_guidance)
+        self.cadence_interp_mode = interpolate_mode_from_string(args.cadence_interp)
+
         # expand key frame strings to per frame series
         frame_args_dict = {f.name: curve_from_cn_string(getattr(args, f.name)) for f in fields(FrameArgs)}
         self.frame_args = FrameArgs(**frame_args_dict)        
@@ -945,22 +989,25 @@ class Animator:
             return None
 
         args = self.args
-        for _ in range(args.extract_nth_frame):
-            success, video_next_frame = self.video_reader.read()
-            video_next_frame = cv2_to_pil(video_next_frame)
+        # skipped frames are only grabbed, not retrieved and converted
+        for _ in range(args.extract_nth_frame - 1):
+            self.video_reader.grab()
+        success, video_next_frame = self.video_reader.read()
         if success:
-            video_next_frame = self.image_resize(video_next_frame, 'cover')
-            mask = None
+            video_next_frame = self.image_resize(cv2_to_pil(video_next_frame), 'cover')
+            mask, next_b64 = None, None
             if args.video_flow_warp and video_next_frame is not None:
                 # warp_flow is in `extras` and will change in the future
-                prev_b64 = base64.b64encode(image_to_png_bytes(self.video_prev_frame)).decode('utf-8')
+                # each video frame is encoded once and reused as prev_frame on the following frame
+                if self.video_prev_frame_b64 is None:
+                    self.video_prev_frame_b64 = base64.b64encode(image_to_png_bytes(self.video_prev_frame)).decode('utf-8')
                 next_b64 = base64.b64encode(image_to_png_bytes(video_next_frame)).decode('utf-8')
-                extras = { "warp_flow": { "prev_frame": prev_b64, "next_frame": next_b64, "export_mask": args.inpaint_border } }
+                extras = { "warp_flow": { "prev_frame": self.video_prev_frame_b64, "next_frame": next_b64, "export_mask": args.inpaint_border } }
                 transformed_prior_frames, masks = self.api.transform(self.prior_frames, generation.TransformParameters(), extras=extras)
                 if masks is not None:
                     mask = masks[0]
                 self.prior_frames.extend(transformed_prior_frames)
-            self.video_prev_frame = video_next_frame
+            self.video_prev_frame, self.video_prev_frame_b64 = video_next_frame, next_b64
             return mask
         return None
 
@@ -986,6 +1033,7 @@ class Animator:
         if binarize:
             mask = np.where(mask > self.args.mask_binarization_thr * 255, 255, 0).astype(np.uint8)
         if blur_radius:
+            import cv2
             kernel_size = blur_radius*2+1
             mask = cv2.erode(mask, np.ones((kernel_size, kernel_size), np.uint8))
             mask = cv2.GaussianBlur(mask, (kernel_size, kernel_size), 0)
@@ -1014,21 +1062,19 @@ class Animator:
 
         init_ops = self.prepare_init_ops(init, frame_idx, seed)
 
-        sampler = sampler_from_string(args.sampler.lower())
-        guidance = guidance_from_string(args.clip_guidance)
         generate_request = self.api.generate(
             prompts, weights, 
             args.width, args.height, 
             steps = adjusted_steps,
             seed = seed,
             cfg_scale = args.cfg_scale,
-            sampler = sampler, 
+            sampler = self.sampler, 
             init_image = init if init_ops is None else None, 
             init_strength = strength if init is not None else 0.0,
             init_noise_scale = self.frame_args.noise_scale_curve[frame_idx], 
             mask = mask if mask is not None else self.mask,
             masked_area_init = generation.MASKED_AREA_INIT_ORIGINAL,
-            guidance_preset = guidance,
+            guidance_preset = self.guidance_preset,
             preset = args.preset,
             return_request = True
         )
@@ -1107,7 +1153,7 @@ class Animator:
             blended = self.api.interpolate(
                 [fwd_fill, bwd_fill], 
                 [t], 
-                interpolate_mode_from_string(args.cadence_interp)
+                self.cadence_interp_mode
             )[0]
             yield start+idx, blended
 
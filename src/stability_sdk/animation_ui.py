@@ -9,7 +9,7 @@ import traceback
 from collections import OrderedDict
 from PIL import Image
 from tqdm import tqdm
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Union
 
 try:
     import gradio as gr
@@ -19,6 +19,11 @@ except ImportError:
         "   pip install --upgrade stability_sdk[anim_ui]"
     )
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from .api import (
     ClassifierException, 
     Context,
@@ -40,6 +45,7 @@ from .animation import (
     interpolate_frames
 )
 from .utils import (
+    PNG_COMPRESS_LEVEL,
     create_video_from_frames,
     extract_frames_from_video,
     interpolate_mode_from_string
@@ -104,11 +110,10 @@ class Project():
     @classmethod
     def list_projects(cls) -> List["Project"]:
         projects = []
-        for path in os.listdir(outputs_path):
-            directory = os.path.join(outputs_path, path)
-            if not os.path.isdir(directory):
-                continue
-
+        # scandir entries carry the file type, avoiding a stat call per entry
+        with os.scandir(outputs_path) as entries:
+            directories = [entry.path for entry in entries if entry.is_dir()]
+        for directory in directories:
             json_files = glob.glob(os.path.join(directory, '*.json'))
             json_files = sorted(json_files, key=lambda x: os.stat(x).st_mtime)
             if not json_files:
@@ -120,7 +125,8 @@ class Project():
 
             project = cls(filename[:filename.rfind('(')-1].strip())
             try:
-                project.settings = json.load(open(os.path.join(directory, filename), 'r'))
+                with open(os.path.join(directory, filename), 'rb') as f:
+                    project.settings = json_loads(f.read())
             except:
                 continue
             projects.append(project)
@@ -270,6 +276,15 @@ def get_default_project():
     })
     return data
 
+def json_loads(data: Union[bytes, str]) -> Any:
+    """Parse JSON with orjson when available, falling back to the json module."""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass # json also accepts NaN and Infinity
+    return json.loads(data)
+
 def post_process_tab():
     with gr.Row():
         with gr.Column():
@@ -328,7 +343,7 @@ def post_process_tab():
                     for frame_idx in tqdm(range(num_frames)):
                         frame = Image.open(frame_paths[frame_idx])
                         frame = context.upscale(frame)
-                        frame.save(os.path.join(upscale_dir, os.path.basename(frame_paths[frame_idx])))
+                        frame.save(os.path.join(upscale_dir, os.path.basename(frame_paths[frame_idx])), compress_level=PNG_COMPRESS_LEVEL)
                         yield {
                             header: gr.update(value=format_header_html()) if frame_idx % 12 == 0 else gr.update(),
                             image_out: gr.update(value=frame, label=f"upscale {frame_idx}/{num_frames}", visible=True),
@@ -421,7 +436,7 @@ def project_import(title, file):
 
     # read json from file
     try:
-        settings = json.loads(file.decode('utf-8'))
+        settings = json_loads(file)
     except Exception as e:
         raise gr.Error(f"Failed to read settings from file: {e}")
 
@@ -582,7 +597,7 @@ def render_tab():
 
         # convert animation_prompts from string (JSON or python) to dict
         try:
-            prompts = json.loads(animation_prompts)
+            prompts = json_loads(animation_prompts)
         except json.JSONDecodeError:
             try:
                 prompts = eval(animation_prompts)
@@ -1,12 +1,20 @@
+import asyncio
+import functools
 import grpc
 import io
+import itertools
 import logging
+import os
 import random
+import threading
 import time
 
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from google.protobuf.internal import api_implementation
 from google.protobuf.struct_pb2 import Struct
 from PIL import Image
-from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 import stability_sdk.interfaces.gooseai.dashboard.dashboard_pb2 as dashboard
 import stability_sdk.interfaces.gooseai.dashboard.dashboard_pb2_grpc as dashboard_grpc
@@ -16,6 +24,7 @@ import stability_sdk.interfaces.gooseai.generation.generation_pb2_grpc as genera
 from .utils import (
     image_mix,
     image_to_prompt,
+    tensor_to_image,
     tensor_to_prompt,
 )
 
@@ -23,11 +32,85 @@ from .utils import (
 logger = logging.getLogger(__name__)
 logger.setLevel(level=logging.INFO)
 
+# multi-megabyte image payloads parse an order of magnitude slower with the pure python backend
+if api_implementation.Type() == "python":
+    logger.warning(
+        "protobuf is using the pure python implementation, image requests will be slow. "
+        "Install a protobuf wheel with the upb/cpp backend and unset PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION."
+    )
+
+_IMAGE_TYPES = frozenset((generation.ARTIFACT_DEPTH, generation.ARTIFACT_IMAGE, generation.ARTIFACT_MASK))
+
+# Pillow releases the GIL while decompressing so returned images can be decoded in parallel
+_decode_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+def _decode_image(binary: bytes) -> Image.Image:
+    image = Image.open(io.BytesIO(binary))
+    image.load()
+    return image
+
+@functools.lru_cache(maxsize=128)
+def _image_params_template(
+    width: int,
+    height: int,
+    sampler: Optional[generation.DiffusionSampler],
+    steps: Optional[int],
+    samples: int,
+    cfg_scale: float,
+    schedule_start: float,
+    init_noise_scale: Optional[float],
+    masked_area_init: generation.MaskedAreaInit,
+    guidance_preset: generation.GuidancePreset,
+    guidance_cuts: int,
+    guidance_strength: float
+) -> bytes:
+    # animations send the same settings for many frames with only the seed changing, so the
+    # nested messages are built once and parsing the serialized template stands in for construction
+    step_parameters = {
+        "scaled_step": 0,
+        "sampler": generation.SamplerParameters(cfg_scale=cfg_scale, init_noise_scale=init_noise_scale),
+    }
+    if schedule_start != 1.0:
+        step_parameters["schedule"] = generation.ScheduleParameters(start=schedule_start)
+
+    if guidance_preset is not generation.GUIDANCE_PRESET_NONE:
+        cutouts = generation.CutoutParameters(count=guidance_cuts) if guidance_cuts else None
+        if guidance_strength == 0.0:
+            guidance_strength = None
+        step_parameters["guidance"] = generation.GuidanceParameters(
+            guidance_preset=guidance_preset,
+            instances=[
+                generation.GuidanceInstanceParameters(
+                    cutouts=cutouts,
+                    guidance_strength=guidance_strength,
+                    models=None, prompt=None
+                )
+            ]
+        )
+
+    return generation.ImageParameters(
+        transform=None if sampler is None else generation.TransformType(diffusion=sampler),
+        height=height,
+        width=width,
+        steps=steps,
+        samples=samples,
+        masked_area_init=masked_area_init,
+        parameters=[generation.StepParameter(**step_parameters)],
+    ).SerializeToString()
+
+@functools.lru_cache(maxsize=64)
+def _text_prompt(text: str, weight: float) -> generation.Prompt:
+    # the cached message is shared, prompts are copied when assigned into a request
+    return generation.Prompt(text=text, parameters=generation.PromptParameters(weight=weight))
 
 def open_channel(host: str, api_key: str = None, max_message_len: int = 20*1024*1024) -> grpc.Channel:
     options=[
         ('grpc.max_send_message_length', max_message_len),
         ('grpc.max_receive_message_length', max_message_len),
+        # batch writes of large image payloads into fewer flushes
+        ('grpc.http2.write_buffer_size', 1024*1024),
+        # give each channel its own connection so pooled channels don't collapse onto one
+        ('grpc.use_local_subchannel_pool', 1),
     ]    
     if host.endswith(":443"):
         call_credentials = [grpc.access_token_call_credentials(api_key)]
@@ -58,9 +141,113 @@ class OutOfCreditsException(Exception):
 
 
 class Endpoint:
-    def __init__(self, stub, engine_id):
+    def __init__(self, stub, engine_id, stubs: Optional[List] = None):
         self.stub = stub
         self.engine_id = engine_id
+        self.stubs = stubs or [stub]
+        self._stub_cycle = itertools.cycle(self.stubs)
+
+    def next_stub(self):
+        """Returns the stubs in round robin order to spread requests over pooled channels."""
+        return next(self._stub_cycle)
+
+
+class _BatchingQueue:
+    """
+    Merges concurrent single sample generate requests which only differ by seed
+    into one multi-sample request, so the server can run them as a single batch.
+    """
+    def __init__(
+        self,
+        run: Callable[[generation.Request], Dict[int, List[Any]]],
+        run_batch: Callable[[generation.Request], Dict[int, Dict[int, List[Any]]]],
+        window: float = 0.02,
+        max_batch_size: int = 8
+    ):
+        self._run = run                         # runs a single request
+        self._run_batch = run_batch             # runs a merged request, returning results keyed by seed
+        self._window = window                   # seconds to wait for more requests to join a batch
+        self._max_batch_size = max_batch_size   # batches this size are sent without waiting
+        self._lock = threading.Lock()
+        self._pending: Dict[bytes, Tuple[List[Tuple[generation.Request, Future]], threading.Timer]] = {}
+
+    def submit(self, request: generation.Request) -> "Future[Dict[int, List[Any]]]":
+        key_request = generation.Request()
+        key_request.CopyFrom(request)
+        key_request.image.ClearField("seed")
+        key = key_request.SerializeToString(deterministic=True)
+
+        future: Future = Future()
+        seed = request.image.seed[0]
+        with self._lock:
+            entry = self._pending.get(key)
+            # samples are matched back to callers by seed, so a repeated seed can't share the batch
+            duplicate = entry is not None and any(rq.image.seed[0] == seed for rq, _ in entry[0])
+            if not duplicate:
+                if entry is None:
+                    batch: List[Tuple[generation.Request, Future]] = []
+                    timer = threading.Timer(self._window, self._flush, (key, batch))
+                    timer.daemon = True
+                    entry = self._pending[key] = (batch, timer)
+                    timer.start()
+                batch, timer = entry
+                batch.append((request, future))
+                full = len(batch) >= self._max_batch_size
+        # only enqueue here, submit is called from the asyncio event loop by agenerate
+        if duplicate:
+            threading.Thread(target=self._resolve, args=(future, request), daemon=True).start()
+        elif full:
+            timer.cancel()
+            threading.Thread(target=self._flush, args=(key, batch), daemon=True).start()
+        return future
+
+    def _flush(self, key: bytes, batch: List[Tuple[generation.Request, Future]]):
+        with self._lock:
+            # the timer and a full batch can both flush, and a newer batch may already use the key
+            entry = self._pending.get(key)
+            if entry is None or entry[0] is not batch:
+                return
+            del self._pending[key]
+
+        if len(batch) == 1:
+            request, future = batch[0]
+            self._resolve(future, request)
+            return
+
+        request = generation.Request()
+        request.CopyFrom(batch[0][0])
+        request.image.seed[:] = [rq.image.seed[0] for rq, _ in batch]
+        request.image.samples = len(batch)
+
+        try:
+            results = self._run_batch(request)
+        except ClassifierException as e:
+            if e.prompt is not None:
+                # a rejected text prompt is shared by every caller
+                for _, future in batch:
+                    future.set_exception(e)
+                return
+            # one obfuscated sample would otherwise reseed or fail the whole batch, retry each caller on its own
+            for rq, future in batch:
+                threading.Thread(target=self._resolve, args=(future, rq), daemon=True).start()
+            return
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for rq, future in batch:
+            seed = rq.image.seed[0]
+            if seed in results:
+                future.set_result(results[seed])
+            else:
+                future.set_exception(RuntimeError(f"Batched response is missing the sample for seed {seed}"))
+
+    def _resolve(self, future: Future, request: generation.Request):
+        try:
+            future.set_result(self._run(request))
+        except Exception as e:
+            future.set_exception(e)
 
 
 class Context:
@@ -74,23 +261,37 @@ class Context:
             interpolate_engine_id: str="interpolation-server-v1",
             transform_engine_id: str="transform-server-v1",
             upscale_engine_id: str="esrgan-v1-x2plus",
+            max_message_len: int=20*1024*1024,
+            max_workers: int=8,
+            num_channels: int=1,
         ):
         if not host and stub is None:
             raise Exception("Must provide either GRPC host or stub to Api")
 
-        channel = open_channel(host, api_key) if host else None
+        channel = open_channel(host, api_key, max_message_len) if host else None
         if not stub:
             stub = generation_grpc.GenerationServiceStub(channel)
 
+        # additional channels let concurrent requests spread over several HTTP/2 connections
+        stubs = [stub]
+        if channel and num_channels > 1:
+            stubs += [
+                generation_grpc.GenerationServiceStub(open_channel(host, api_key, max_message_len))
+                for _ in range(num_channels-1)
+            ]
+
         self._dashboard_stub = dashboard_grpc.DashboardServiceStub(channel) if channel else None
 
-        self._generate = Endpoint(stub, generate_engine_id)
-        self._inpaint = Endpoint(stub, inpaint_engine_id)
-        self._interpolate = Endpoint(stub, interpolate_engine_id)
-        self._transform = Endpoint(stub, transform_engine_id)
-        self._upscale = Endpoint(stub, upscale_engine_id)
+        self._generate = Endpoint(stub, generate_engine_id, stubs)
+        self._inpaint = Endpoint(stub, inpaint_engine_id, stubs)
+        self._interpolate = Endpoint(stub, interpolate_engine_id, stubs)
+        self._transform = Endpoint(stub, transform_engine_id, stubs)
+        self._upscale = Endpoint(stub, upscale_engine_id, stubs)
 
+        self._compress_tensors = True     # gzip requests carrying uncompressed tensor payloads
         self._debug_no_chains = False
+        self._dynamic_batching = False    # merge concurrent single sample generate calls that only differ by seed
+        self._image_encoding = 'png'      # image prompt transport, 'raw' skips PNG encoding at ~3x the payload
         self._max_retries = 5             # retry request on RPC error
         self._request_timeout = 30.0      # timeout in seconds for each request
         self._retry_delay = 1.0           # base delay in seconds between retries, each attempt will double
@@ -100,6 +301,14 @@ class Context:
         self._user_organization_id: Optional[str] = None
         self._user_profile_picture: str = ''
 
+        # gRPC releases the GIL while waiting on the network so requests can be in flight concurrently
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        self._batcher = _BatchingQueue(
+            lambda request: self._run_request(self._generate, request),
+            lambda request: self._run_request(self._generate, request, by_seed=True),
+        )
+
     def generate(
         self,
         prompts: List[str], 
@@ -147,36 +356,51 @@ class Context:
         :param return_request: Whether to return the request instead of running it
         :return: dict mapping artifact type to data
         """
-        if not prompts and init_image is None:
-            raise ValueError("prompt and/or init_image must be provided")
+        request = self._build_generate_request(
+            prompts, weights, width, height, steps, seed, samples, cfg_scale, sampler,
+            init_image, init_strength, init_noise_scale, init_depth, mask, masked_area_init,
+            guidance_preset, guidance_cuts, guidance_strength, preset,
+            init_image_pending=return_request
+        )
+        if return_request:
+            return request
 
-        if (mask is not None) and (init_image is None) and not return_request:
-            raise ValueError("If mask_image is provided, init_image must also be provided")
+        if self._batchable(request):
+            return self._batcher.submit(request).result()
 
-        p = [generation.Prompt(text=prompt, parameters=generation.PromptParameters(weight=weight)) for prompt,weight in zip(prompts, weights)]
-        if init_image is not None:
-            p.append(image_to_prompt(init_image))
-        if mask is not None:
-            p.append(image_to_prompt(mask, type=generation.ARTIFACT_MASK))
-        if init_depth is not None:
-            p.append(image_to_prompt(init_depth, type=generation.ARTIFACT_DEPTH))
+        results = self._run_request(self._generate, request)
 
-        start_schedule = 1.0 - init_strength
-        image_params = self._build_image_params(width, height, sampler, steps, seed, samples, cfg_scale, 
-                                                start_schedule, init_noise_scale, masked_area_init, 
-                                                guidance_preset, guidance_cuts, guidance_strength)
+        return results
 
-        extras = Struct()
-        if preset and preset.lower() != 'none':
-            extras.update({ '$IPC': { "preset": preset } })
+    def generate_async(self, *args, **kwargs) -> "Future[Dict[int, List[Any]]]":
+        """
+        Submit a generate request to run in the background.
 
-        request = generation.Request(engine_id=self._generate.engine_id, prompt=p, image=image_params, extras=extras)
-        if return_request:
-            return request
+        Takes the same arguments as :meth:`generate`. Multiple calls can be in
+        flight at once, e.g. to pipeline independent animation frames. This is
+        for threaded code and returns a concurrent.futures.Future, from an asyncio
+        event loop use the :meth:`agenerate` coroutine instead.
 
-        results = self._run_request(self._generate, request)
+        :return: Future resolving to the dict mapping artifact type to data
+        """
+        return self._executor.submit(self.generate, *args, **kwargs)
 
-        return results
+    async def agenerate(self, *args, **kwargs) -> Dict[int, List[Any]]:
+        """
+        Coroutine version of :meth:`generate` for use from an asyncio event loop.
+
+        Takes the same arguments as :meth:`generate` except return_request. Retry
+        backoff awaits instead of sleeping, so other requests keep running while one waits.
+        Unlike :meth:`generate_async`, which returns a thread Future, this must be awaited.
+
+        :return: dict mapping artifact type to data
+        """
+        # image prompts are encoded in the executor to keep the event loop free
+        loop = asyncio.get_running_loop()
+        request = await loop.run_in_executor(self._executor, functools.partial(self._build_generate_request, *args, **kwargs))
+        if self._batchable(request):
+            return await asyncio.wrap_future(self._batcher.submit(request))
+        return await self._run_request_async(self._generate, request)
 
     def get_user_info(self) -> Tuple[float, str]:
         """Get the number of credits the user has remaining and their profile picture."""
@@ -227,9 +451,10 @@ class Context:
         :param preset: Style preset to use
         :return: dict mapping artifact type to data
         """
-        p = [generation.Prompt(text=prompt, parameters=generation.PromptParameters(weight=weight)) for prompt,weight in zip(prompts, weights)]
-        p.append(image_to_prompt(image))
-        p.append(image_to_prompt(mask, type=generation.ARTIFACT_MASK))
+        p = list(itertools.chain(
+            (_text_prompt(prompt, weight) for prompt, weight in zip(prompts, weights)),
+            (image_to_prompt(image, encoding=self._image_encoding), image_to_prompt(mask, type=generation.ARTIFACT_MASK, encoding=self._image_encoding))
+        ))
 
         width, height = image.size
         start_schedule = 1.0-init_strength
@@ -263,15 +488,20 @@ class Context:
         assert len(images) == 2
         assert len(ratios) >= 1
 
+        # linear blends are cheaper to do locally than a round trip to the server
+        if mode == generation.INTERPOLATE_LINEAR:
+            return [
+                images[0] if ratio == 0.0 else images[1] if ratio == 1.0 else image_mix(images[0], images[1], ratio)
+                for ratio in ratios
+            ]
+
         if len(ratios) == 1:
             if ratios[0] == 0.0:
                 return [images[0]]
             elif ratios[0] == 1.0:
                 return [images[1]]
-            elif mode == generation.INTERPOLATE_LINEAR:
-               return [image_mix(images[0], images[1], ratios[0])]
 
-        p = [image_to_prompt(image) for image in images]
+        p = [image_to_prompt(image, encoding=self._image_encoding) for image in images]
         request = generation.Request(
             engine_id=self._interpolate.engine_id,
             prompt=p,
@@ -298,11 +528,12 @@ class Context:
             return results[generation.ARTIFACT_IMAGE][0]
 
         assert image is not None
+        image_prompt = image_to_prompt(image, encoding=self._image_encoding)
         requests = [
             generation.Request(
                 engine_id=self._transform.engine_id,
                 requested_type=generation.ARTIFACT_TENSOR,
-                prompt=[image_to_prompt(image)],
+                prompt=[image_prompt],
                 transform=param,
                 extras=extras_struct,
             ) for param in params
@@ -362,21 +593,29 @@ class Context:
             extras_struct = Struct()
             extras_struct.update(extras)
 
-        if isinstance(params, List) and len(params) > 1:
+        params_list = params if isinstance(params, list) else [params]
+        if len(params_list) > 1:
             if self._debug_no_chains:
-                for param in params:
-                    images, mask = self.transform(images, param, extras)
-                return images, mask
+                # run each step separately, only the final step's images are decoded
+                for idx, param in enumerate(params_list):
+                    request = generation.Request(
+                        engine_id=self._transform.engine_id,
+                        prompt=[image_to_prompt(image, encoding=self._image_encoding) for image in images],
+                        transform=param,
+                        extras=extras_struct
+                    )
+                    results = self._run_request(self._transform, request, decode_images=idx == len(params_list) - 1)
+                    images = results.get(generation.ARTIFACT_IMAGE, []) + results.get(generation.ARTIFACT_DEPTH, [])
+                return images, results.get(generation.ARTIFACT_MASK, None)
 
-            assert extras is None
             stages = []
-            for idx, param in enumerate(params):
-                final = idx == len(params) - 1
+            for idx, param in enumerate(params_list):
+                final = idx == len(params_list) - 1
                 rq = generation.Request(
                     engine_id=self._transform.engine_id,
-                    prompt=[image_to_prompt(image) for image in images] if idx == 0 else None,
+                    prompt=[image_to_prompt(image, encoding=self._image_encoding) for image in images] if idx == 0 else None,
                     transform=param,
-                    extras_struct=extras_struct
+                    extras=extras_struct
                 )
                 stages.append(generation.Stage(
                     id=str(idx),
@@ -391,8 +630,8 @@ class Context:
         else:
             request = generation.Request(
                 engine_id=self._transform.engine_id,
-                prompt=[image_to_prompt(image) for image in images],
-                transform=params[0] if isinstance(params, List) else params,
+                prompt=[image_to_prompt(image, encoding=self._image_encoding) for image in images],
+                transform=params_list[0],
                 extras=extras_struct
             )
             results = self._run_request(self._transform, request)
@@ -411,7 +650,7 @@ class Context:
         assert len(images)
         assert isinstance(images[0], Image.Image)
 
-        image_prompts = [image_to_prompt(image) for image in images]
+        image_prompts = [image_to_prompt(image, encoding=self._image_encoding) for image in images]
         warped_images = []
         warp_mask = None
         op_id = "resample" if transform.HasField("resample") else "camera_pose"
@@ -435,14 +674,7 @@ class Context:
 
         if self._debug_no_chains:
             results = self._run_request(self._transform, rq_depth)
-            rq_transform.prompt.append(
-                generation.Prompt(
-                    artifact=generation.Artifact(
-                        type=generation.ARTIFACT_TENSOR,
-                        tensor=results[generation.ARTIFACT_TENSOR][0]
-                    )
-                )
-            )
+            rq_transform.prompt.append(tensor_to_prompt(results[generation.ARTIFACT_TENSOR][0]))
             results = self._run_request(self._transform, rq_transform)
         else:
             chain_rq = generation.ChainRequest(
@@ -497,7 +729,7 @@ class Context:
         :return: Tuple of (prompts, image_parameters)
         """
 
-        prompts = [image_to_prompt(init_image)]
+        prompts = [image_to_prompt(init_image, encoding=self._image_encoding)]
         if prompt:
             if isinstance(prompt, str):
                 prompt = generation.Prompt(text=prompt)
@@ -530,12 +762,92 @@ class Context:
 
     def _adjust_request_for_retry(self, request: generation.Request, attempt: int):
         logger.warning(f"  adjusting request, will retry {self._max_retries-attempt} more times")
-        request.image.seed[:] = [random.randrange(0, 4294967295) for _ in request.image.seed]
+        seeds = request.image.seed
+        for i in range(len(seeds)):
+            seeds[i] = random.randrange(0, 4294967295)
         if attempt > 0 and request.image.parameters and request.image.parameters[0].HasField("schedule"):
             schedule = request.image.parameters[0].schedule
             if schedule.HasField("start"):
                 schedule.start = max(0.0, min(1.0, schedule.start + self._retry_schedule_offset))
 
+    def _attempt_request(
+        self,
+        endpoint: Endpoint,
+        request: Union[generation.ChainRequest, generation.Request],
+        decode_images: bool = True,
+        by_seed: bool = False
+    ) -> Dict[int, Any]:
+        stub = endpoint.next_stub()
+        compression = self._request_compression(request)
+        if isinstance(request, generation.Request):
+            response = stub.Generate(request, timeout=self._request_timeout, compression=compression)
+        else:
+            response = stub.ChainGenerate(request, timeout=self._request_timeout, compression=compression)
+
+        results = self._process_response(response, decode_images, by_seed)
+
+        # check for classifier obfuscation
+        for sample_results in (results.values() if by_seed else (results,)):
+            for classifier in sample_results.get(generation.ARTIFACT_CLASSIFICATIONS, ()):
+                if classifier.realized_action == generation.ACTION_OBFUSCATE:
+                    raise ClassifierException(classifier)
+
+        return results
+
+    def _batchable(self, request: generation.Request) -> bool:
+        return self._dynamic_batching and request.image.samples == 1 and len(request.image.seed) == 1
+
+    def _build_generate_request(
+        self,
+        prompts: List[str],
+        weights: List[float],
+        width: int = 1024,
+        height: int = 1024,
+        steps: Optional[int] = None,
+        seed: Union[Sequence[int], int] = 0,
+        samples: int = 1,
+        cfg_scale: float = 7.0,
+        sampler: generation.DiffusionSampler = None,
+        init_image: Optional[Image.Image] = None,
+        init_strength: float = 0.0,
+        init_noise_scale: Optional[float] = None,
+        init_depth: Optional[Image.Image] = None,
+        mask: Optional[Image.Image] = None,
+        masked_area_init: generation.MaskedAreaInit = generation.MASKED_AREA_INIT_ORIGINAL,
+        guidance_preset: generation.GuidancePreset = generation.GUIDANCE_PRESET_NONE,
+        guidance_cuts: int = 0,
+        guidance_strength: float = 0.0,
+        preset: Optional[str] = None,
+        init_image_pending: bool = False,
+    ) -> generation.Request:
+        # init_image_pending is for requests returned to callers which add the init image themselves
+        if not prompts and init_image is None:
+            raise ValueError("prompt and/or init_image must be provided")
+
+        if (mask is not None) and (init_image is None) and not init_image_pending:
+            raise ValueError("If mask_image is provided, init_image must also be provided")
+
+        image_inputs = (
+            (init_image, generation.ARTIFACT_IMAGE),
+            (mask, generation.ARTIFACT_MASK),
+            (init_depth, generation.ARTIFACT_DEPTH),
+        )
+        p = list(itertools.chain(
+            (_text_prompt(prompt, weight) for prompt, weight in zip(prompts, weights)),
+            (image_to_prompt(image, type=type, encoding=self._image_encoding) for image, type in image_inputs if image is not None)
+        ))
+
+        start_schedule = 1.0 - init_strength
+        image_params = self._build_image_params(width, height, sampler, steps, seed, samples, cfg_scale, 
+                                                start_schedule, init_noise_scale, masked_area_init, 
+                                                guidance_preset, guidance_cuts, guidance_strength)
+
+        extras = Struct()
+        if preset and preset.lower() != 'none':
+            extras.update({ '$IPC': { "preset": preset } })
+
+        return generation.Request(engine_id=self._generate.engine_id, prompt=p, image=image_params, extras=extras)
+
     def _build_image_params(self, width, height, sampler, steps, seed, samples, cfg_scale, 
                             schedule_start, init_noise_scale, masked_area_init, 
                             guidance_preset, guidance_cuts, guidance_strength):
@@ -547,116 +859,141 @@ class Context:
         else:
             seed = list(seed)
 
-        step_parameters = {
-            "scaled_step": 0,
-            "sampler": generation.SamplerParameters(cfg_scale=cfg_scale, init_noise_scale=init_noise_scale),
-        }
-        if schedule_start != 1.0:
-            step_parameters["schedule"] = generation.ScheduleParameters(start=schedule_start)
-
-        if guidance_preset is not generation.GUIDANCE_PRESET_NONE:
-            cutouts = generation.CutoutParameters(count=guidance_cuts) if guidance_cuts else None
-            if guidance_strength == 0.0:
-                guidance_strength = None
-            step_parameters["guidance"] = generation.GuidanceParameters(
-                guidance_preset=guidance_preset,
-                instances=[
-                    generation.GuidanceInstanceParameters(
-                        cutouts=cutouts,
-                        guidance_strength=guidance_strength,
-                        models=None, prompt=None
-                    )
-                ]
-            )
+        template = _image_params_template(width, height, sampler, steps, samples, cfg_scale, 
+                                          schedule_start, init_noise_scale, masked_area_init, 
+                                          guidance_preset, guidance_cuts, guidance_strength)
+        image_params = generation.ImageParameters.FromString(template)
+        image_params.seed.extend(seed)
+        return image_params
 
-        return generation.ImageParameters(
-            transform=None if sampler is None else generation.TransformType(diffusion=sampler),
-            height=height,
-            width=width,
-            seed=seed,
-            steps=steps,
-            samples=samples,
-            masked_area_init=masked_area_init,
-            parameters=[generation.StepParameter(**step_parameters)],
-        )
+    def _handle_request_error(
+        self,
+        request: Union[generation.ChainRequest, generation.Request],
+        error: Exception,
+        attempt: int
+    ) -> float:
+        """Re-raises errors that can't be retried, otherwise returns the delay before the next attempt."""
+        if isinstance(error, ClassifierException):
+            ce = error
+            if attempt == self._max_retries or not self._retry_obfuscation or ce.prompt is not None:
+                raise ce
+            
+            for exceed in ce.classifier_result.exceeds:
+                logger.warning(f"Received classifier obfuscation. Exceeded {exceed.name} threshold")
+            
+            if isinstance(request, generation.Request) and request.HasField("image"):
+                self._adjust_request_for_retry(request, attempt)
+            elif isinstance(request, generation.ChainRequest):
+                for stage in request.stage:
+                    if stage.request.HasField("image"):
+                        self._adjust_request_for_retry(stage.request, attempt)
+            else:
+                raise ce
+            return 0.0
+
+        rpc_error = error
+        if hasattr(rpc_error, "code"):
+            if rpc_error.code() == grpc.StatusCode.RESOURCE_EXHAUSTED:
+                if "message larger than max" in rpc_error.details():
+                    raise rpc_error
+                raise OutOfCreditsException(rpc_error.details())
+            elif rpc_error.code() == grpc.StatusCode.UNAUTHENTICATED:
+                raise rpc_error
 
-    def _process_response(self, response) -> Dict[int, List[Any]]:
-        results: Dict[int, List[Any]] = {}
-        for resp in response:
-            for artifact in resp.artifacts:
-                # check for classifier rejecting a text prompt
-                if artifact.finish_reason == generation.FILTER and artifact.type == generation.ARTIFACT_TEXT:
-                    raise ClassifierException(prompt=artifact.text)
-
-                if artifact.type not in results:
-                    results[artifact.type] = []
-
-                if artifact.type == generation.ARTIFACT_CLASSIFICATIONS:
-                    results[artifact.type].append(artifact.classifier)
-                elif artifact.type in (generation.ARTIFACT_DEPTH, generation.ARTIFACT_IMAGE, generation.ARTIFACT_MASK):
-                    image = Image.open(io.BytesIO(artifact.binary))
-                    results[artifact.type].append(image)
-                elif artifact.type == generation.ARTIFACT_TENSOR:
-                    results[artifact.type].append(artifact.tensor)
-                elif artifact.type == generation.ARTIFACT_TEXT:
-                    results[artifact.type].append(artifact.text)
+        if attempt == self._max_retries:
+            raise rpc_error
 
-        return results
+        logger.warning(f"Received RpcError: {rpc_error} will retry {self._max_retries-attempt} more times")
+        return self._retry_delay * 2**attempt
 
-    def _run_request(
-        self, 
-        endpoint: Endpoint, 
-        request: Union[generation.ChainRequest, generation.Request]
-    ) -> Dict[int, List[Any]]:        
+    def _prepare_request(self, request: Union[generation.ChainRequest, generation.Request]):
         if isinstance(request, generation.Request):
             self._adjust_request_engine(request)
         elif isinstance(request, generation.ChainRequest):
             for stage in request.stage:
                 self._adjust_request_engine(stage.request)
 
-        for attempt in range(self._max_retries+1):
-            try:
-                if isinstance(request, generation.Request):
-                    response = endpoint.stub.Generate(request, timeout=self._request_timeout)
-                else:
-                    response = endpoint.stub.ChainGenerate(request, timeout=self._request_timeout)
-
-                results = self._process_response(response)
-
-                # check for classifier obfuscation
-                if generation.ARTIFACT_CLASSIFICATIONS in results:
-                    for classifier in results[generation.ARTIFACT_CLASSIFICATIONS]:
-                        if classifier.realized_action == generation.ACTION_OBFUSCATE:
-                            raise ClassifierException(classifier)
-
-                break
-            except ClassifierException as ce:
-                if attempt == self._max_retries or not self._retry_obfuscation or ce.prompt is not None:
-                    raise ce
-                
-                for exceed in ce.classifier_result.exceeds:
-                    logger.warning(f"Received classifier obfuscation. Exceeded {exceed.name} threshold")
-                
-                if isinstance(request, generation.Request) and request.HasField("image"):
-                    self._adjust_request_for_retry(request, attempt)
-                elif isinstance(request, generation.ChainRequest):
-                    for stage in request.stage:
-                        if stage.request.HasField("image"):
-                            self._adjust_request_for_retry(stage.request, attempt)
+    def _process_response(self, response, decode_images: bool = True, by_seed: bool = False) -> Dict[int, Any]:
+        # with by_seed the results of each sample are kept apart, keyed by artifact seed
+        grouped: Dict[int, Dict[int, List[Any]]] = defaultdict(lambda: defaultdict(list))
+        pending: List[Tuple[List[Any], int, Future]] = []
+        for artifact in itertools.chain.from_iterable(resp.artifacts for resp in response):
+            # check for classifier rejecting a text prompt
+            if artifact.finish_reason == generation.FILTER and artifact.type == generation.ARTIFACT_TEXT:
+                raise ClassifierException(prompt=artifact.text)
+
+            items = grouped[artifact.seed if by_seed else 0][artifact.type]
+            if artifact.type == generation.ARTIFACT_CLASSIFICATIONS:
+                items.append(artifact.classifier)
+            elif artifact.type in _IMAGE_TYPES:
+                # uncompressed images arrive as tensors and need no decode
+                if not artifact.binary and artifact.HasField("tensor"):
+                    items.append(tensor_to_image(artifact.tensor))
+                elif not decode_images:
+                    # intermediate results that are only sent back to the server stay encoded
+                    items.append(artifact.binary)
                 else:
-                    raise ce
-            except grpc.RpcError as rpc_error:
-                if hasattr(rpc_error, "code"):
-                    if rpc_error.code() == grpc.StatusCode.RESOURCE_EXHAUSTED:
-                        if "message larger than max" in rpc_error.details():
-                            raise rpc_error
-                        raise OutOfCreditsException(rpc_error.details())
-                    elif rpc_error.code() == grpc.StatusCode.UNAUTHENTICATED:
-                        raise rpc_error
-
-                if attempt == self._max_retries:
-                    raise rpc_error
+                    # decode in the background while the rest of the stream is still being received
+                    decoded = _decode_executor.submit(_decode_image, artifact.binary)
+                    pending.append((items, len(items), decoded))
+                    items.append(None)
+            elif artifact.type == generation.ARTIFACT_TENSOR:
+                items.append(artifact.tensor)
+            elif artifact.type == generation.ARTIFACT_TEXT:
+                items.append(artifact.text)
+
+        for slots, idx, decoded in pending:
+            slots[idx] = decoded.result()
+
+        if by_seed:
+            return {seed: dict(results) for seed, results in grouped.items()}
+        return dict(grouped[0])
+
+    def _request_compression(
+        self,
+        request: Union[generation.ChainRequest, generation.Request]
+    ) -> Optional[grpc.Compression]:
+        # PNG prompts are already compressed, only raw tensors and PPM images are worth spending gzip time on
+        if not self._compress_tensors:
+            return None
+        requests = [stage.request for stage in request.stage] if isinstance(request, generation.ChainRequest) else [request]
+        for rq in requests:
+            if any(
+                prompt.artifact.HasField("tensor") or prompt.artifact.mime == "image/x-portable-anymap"
+                for prompt in rq.prompt if prompt.HasField("artifact")
+            ):
+                return grpc.Compression.Gzip
+        return None
 
-                logger.warning(f"Received RpcError: {rpc_error} will retry {self._max_retries-attempt} more times")
-                time.sleep(self._retry_delay * 2**attempt)
-        return results
+    def _run_request(
+        self, 
+        endpoint: Endpoint, 
+        request: Union[generation.ChainRequest, generation.Request],
+        decode_images: bool = True,
+        by_seed: bool = False
+    ) -> Dict[int, Any]:        
+        self._prepare_request(request)
+        for attempt in range(self._max_retries+1):
+            try:
+                return self._attempt_request(endpoint, request, decode_images, by_seed)
+            except (ClassifierException, grpc.RpcError) as error:
+                if by_seed and isinstance(error, ClassifierException):
+                    raise   # merged batches are split up and retried per caller rather than reseeded
+                delay = self._handle_request_error(request, error, attempt)
+            if delay:
+                time.sleep(delay)
+
+    async def _run_request_async(
+        self,
+        endpoint: Endpoint,
+        request: Union[generation.ChainRequest, generation.Request]
+    ) -> Dict[int, List[Any]]:
+        self._prepare_request(request)
+        loop = asyncio.get_running_loop()
+        for attempt in range(self._max_retries+1):
+            try:
+                return await loop.run_in_executor(self._executor, self._attempt_request, endpoint, request)
+            except (ClassifierException, grpc.RpcError) as error:
+                delay = self._handle_request_error(request, error, attempt)
+            if delay:
+                await asyncio.sleep(delay)
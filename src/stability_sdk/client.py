@@ -675,7 +675,8 @@ def process_cli(
         if args.gui:
             from .animation_ui import create_ui
             from .api import Context
-            ui = create_ui(Context(STABILITY_HOST, STABILITY_KEY), args.output)
+            # animation requests carry several full resolution images
+            ui = create_ui(Context(STABILITY_HOST, STABILITY_KEY, max_message_len=32*1024*1024), args.output)
             ui.queue(concurrency_count=2, max_size=2)
             ui.launch(show_api=False, debug=True, height=768, share=args.share, show_error=True)
             sys.exit(0)
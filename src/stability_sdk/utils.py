@@ -1,10 +1,14 @@
+import functools
+import hashlib
 import io
+import itertools
 import logging
 import os
 import subprocess
 
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-from typing import Dict, Generator, Optional, Sequence, Tuple, Type, TypeVar, Union
+from typing import Dict, Generator, List, Optional, Sequence, Tuple, Type, TypeVar, Union
 
 from .api import generation
 from .matrix import Matrix
@@ -15,6 +19,15 @@ logger.setLevel(level=logging.INFO)
 
 MAX_FILENAME_SZ = int(os.getenv("MAX_FILENAME_SZ", 200))
 
+# zlib level for PNG prompts and frames written to disk, generated images barely shrink past level 1 but take several times longer to encode
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", 1))
+
+# decodes and launches viewers for open_images without holding up the generator
+_image_open_pool = ThreadPoolExecutor(max_workers=2)
+
+# number of encoded image prompts memoized by image_to_prompt
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", 8))
+
 
 #==============================================================================
 # Mappings from strings to protobuf enums
@@ -72,32 +85,59 @@ SAMPLERS: Dict[str, int] = {
     "k_dpmpp_2s_ancestral": generation.SAMPLER_K_DPMPP_2S_ANCESTRAL
 }
 
+# tensorizer Dtype enum names to numpy dtypes
+TENSOR_DTYPES: Dict[str, str] = {
+    "DT_BOOL": "bool",
+    "DT_FLOAT16": "float16",
+    "DT_FLOAT32": "float32",
+    "DT_FLOAT64": "float64",
+    "DT_INT8": "int8",
+    "DT_INT16": "int16",
+    "DT_INT32": "int32",
+    "DT_INT64": "int64",
+    "DT_UINT8": "uint8",
+}
+
+@functools.lru_cache(maxsize=None)
+def _tensor_dtype_enum():
+    # the tensorizer Dtype enum, reached through Artifact.tensor since tensors_pb isn't imported here
+    return generation.Artifact.DESCRIPTOR.fields_by_name['tensor'].message_type.fields_by_name['dtype'].enum_type
+
 T = TypeVar('T')
 
 def _from_string(s: str, mapping: Dict[str, T], name: str, enum_cls: Type[T]) -> T:
-    enum_value = mapping.get(s.lower().strip())
+    enum_value = mapping.get(s)     # callers usually pass an already normalized key
+    if enum_value is None:
+        enum_value = mapping.get(s.lower().strip())
     if enum_value is None:
         raise ValueError(f"invalid {name}: {s}")
     return enum_value
 
+@functools.lru_cache(maxsize=64)
 def border_mode_from_string(s: str) -> generation.BorderMode:
     return _from_string(s, BORDER_MODES, "border mode", generation.BorderMode)
 
+@functools.lru_cache(maxsize=64)
 def camera_type_from_string(s: str) -> generation.CameraType:
     return _from_string(s, CAMERA_TYPES, "camera type", generation.CameraType)
 
+@functools.lru_cache(maxsize=64)
 def color_match_from_string(s: str) -> generation.ColorMatchMode:
     return _from_string(s, COLOR_MATCH_MODES, "color match", generation.ColorMatchMode)
 
+@functools.lru_cache(maxsize=64)
 def guidance_from_string(s: str) -> generation.GuidancePreset:
     return _from_string(s, GUIDANCE_PRESETS, "guidance preset", generation.GuidancePreset)
 
+@functools.lru_cache(maxsize=64)
 def interpolate_mode_from_string(s: str) -> generation.InterpolateMode:
     return _from_string(s, INTERPOLATE_MODES, "interpolate mode", generation.InterpolateMode)
 
+@functools.lru_cache(maxsize=64)
 def render_mode_from_string(s: str) -> generation.RenderMode:
     return _from_string(s, RENDER_MODES, "render mode", generation.RenderMode)
 
+@functools.lru_cache(maxsize=64)
 def sampler_from_string(s: str) -> generation.DiffusionSampler:
     return _from_string(s, SAMPLERS, "sampler", generation.DiffusionSampler)
 
@@ -106,6 +146,15 @@ def sampler_from_string(s: str) -> generation.DiffusionSampler:
 # Transform helper functions
 #==============================================================================
 
+@functools.lru_cache(maxsize=8)
+def _encode_match_image(mode: str, size: Tuple[int, int], pixels: bytes) -> bytes:
+    # animations reuse the same color match reference for many frames, keying on the
+    # pixels (rather than id()) stays correct if an image is modified in place
+    return image_to_jpg_bytes(Image.frombytes(mode, size, pixels))
+
+def _flatten(matrix: Matrix) -> List[float]:
+    return list(itertools.chain.from_iterable(matrix))
+
 def camera_pose_transform(
     transform: Matrix,
     near_plane: float,
@@ -120,7 +169,7 @@ def camera_pose_transform(
         near_plane=near_plane, far_plane=far_plane, fov=fov)
     return generation.TransformParameters(
         camera_pose=generation.TransformCameraPose(
-            world_to_view_matrix=generation.TransformMatrix(data=sum(transform, [])),
+            world_to_view_matrix=generation.TransformMatrix(data=_flatten(transform)),
             camera_parameters=camera_parameters,
             render_mode=render_mode_from_string(render_mode),
             do_prefill=do_prefill
@@ -138,24 +187,11 @@ def color_adjust_transform(
     noise_amount: float=0.0,
     noise_seed: int=0
 ) -> generation.TransformParameters:
-    if match_mode == 'None':
-        match_mode = 'RGB'
-        match_image = None
-    return generation.TransformParameters(
-        color_adjust=generation.TransformColorAdjust(
-            brightness=brightness,
-            contrast=contrast,
-            hue=hue,
-            saturation=saturation,
-            lightness=lightness,
-            match_image=generation.Artifact(
-                type=generation.ARTIFACT_IMAGE,
-                binary=image_to_jpg_bytes(match_image),
-            ) if match_image is not None else None,
-            match_mode=color_match_from_string(match_mode),
-            noise_amount=noise_amount,
-            noise_seed=noise_seed,
-        ))
+    # a fresh builder owns the message, so it can be handed out as is
+    return TransformOpBuilder().color_adjust(
+        brightness, contrast, hue, saturation, lightness,
+        match_image, match_mode, noise_amount, noise_seed
+    )
 
 def depth_calc_transform(
     blend_weight: float,
@@ -180,13 +216,57 @@ def resample_transform(
     return generation.TransformParameters(
         resample=generation.TransformResample(
             border_mode=border_mode_from_string(border_mode),
-            transform=generation.TransformMatrix(data=sum(transform, [])),
-            prev_transform=generation.TransformMatrix(data=sum(prev_transform, [])) if prev_transform else None,
+            transform=generation.TransformMatrix(data=_flatten(transform)),
+            prev_transform=generation.TransformMatrix(data=_flatten(prev_transform)) if prev_transform else None,
             depth_warp=depth_warp,
             export_mask=export_mask
         )
     )
 
+class TransformOpBuilder:
+    """
+    Builds transform operations into persistent messages which are updated in place
+    each frame instead of being allocated anew.
+
+    The returned message is reused by the next call to the same method, so it must be
+    consumed (assigning it into a request copies it) before building the next one.
+    """
+    def __init__(self):
+        self._color_adjust = generation.TransformParameters()
+        self._color_adjust.color_adjust.SetInParent()
+
+    def color_adjust(
+        self,
+        brightness: float=1.0,
+        contrast: float=1.0,
+        hue: float=0.0,
+        saturation: float=1.0,
+        lightness: float=0.0,
+        match_image: Optional[Image.Image]=None,
+        match_mode: str='LAB',
+        noise_amount: float=0.0,
+        noise_seed: int=0
+    ) -> generation.TransformParameters:
+        """Same as color_adjust_transform, but reuses the builder's message."""
+        if match_mode == 'None':
+            match_mode = 'RGB'
+            match_image = None
+        op = self._color_adjust.color_adjust
+        op.brightness = brightness
+        op.contrast = contrast
+        op.hue = hue
+        op.saturation = saturation
+        op.lightness = lightness
+        if match_image is not None:
+            op.match_image.type = generation.ARTIFACT_IMAGE
+            op.match_image.binary = _encode_match_image(match_image.mode, match_image.size, match_image.tobytes())
+        else:
+            op.ClearField("match_image")
+        op.match_mode = color_match_from_string(match_mode)
+        op.noise_amount = noise_amount
+        op.noise_seed = noise_seed
+        return self._color_adjust
+
 
 #==============================================================================
 # General utility functions
@@ -283,6 +363,15 @@ def image_mix(img_a: Image.Image, img_b: Image.Image, ratio: Union[float, Image.
 
     return Image.blend(img_a, img_b, ratio)
 
+@functools.lru_cache(maxsize=None)
+def _import_simplejpeg():
+    # deferred, simplejpeg pulls in numpy which most callers of utils never need
+    try:
+        import simplejpeg
+    except ImportError:
+        return None
+    return simplejpeg
+
 def image_to_jpg_bytes(image: Image.Image, quality: int=90) -> bytes:
     """
     Compresses an image to a JPEG byte array.
@@ -290,35 +379,116 @@ def image_to_jpg_bytes(image: Image.Image, quality: int=90) -> bytes:
     :param quality: The JPEG quality to use.
     :return: The JPEG byte array.
     """
+    simplejpeg = _import_simplejpeg() if image.mode in ('RGB', 'L') else None
+    if simplejpeg is not None:
+        # libjpeg-turbo straight from the pixel buffer, skipping PIL's encoder setup
+        import numpy as np
+        pixels = np.asarray(image)
+        if image.mode == 'L':
+            return simplejpeg.encode_jpeg(pixels[:, :, None], quality=quality, colorspace='GRAY')
+        return simplejpeg.encode_jpeg(pixels, quality=quality, colorspace='RGB')
+
     buf = io.BytesIO()
     image.save(buf, format="JPEG", quality=quality)
     buf.seek(0)
     return buf.getvalue()
 
-def image_to_png_bytes(image: Image.Image) -> bytes:
+def image_to_png_bytes(image: Image.Image, compress_level: int=PNG_COMPRESS_LEVEL) -> bytes:
     """
     Compresses an image to a PNG byte array.
     :param image: The image to convert.
+    :param compress_level: The zlib compression level (0-9). Lower is faster, higher is smaller.
     :return: The PNG byte array.
     """
     buf = io.BytesIO()
-    image.save(buf, format="PNG")
+    image.save(buf, format="PNG", compress_level=compress_level)
     buf.seek(0)
     return buf.getvalue()
 
+def clear_prompt_cache():
+    """
+    Drop the image prompts memoized by image_to_prompt.
+    """
+    _cached_image_prompt.cache_clear()
+
 def image_to_prompt(
-    image: Image.Image,
-    type: generation.ArtifactType=generation.ARTIFACT_IMAGE
+    image: Union[Image.Image, bytes],
+    type: generation.ArtifactType=generation.ARTIFACT_IMAGE,
+    encoding: str='png'
 ) -> generation.Prompt:
     """
     Create Prompt message type from an image.
-    :param image: The image.
+    :param image: The image, or already encoded image bytes which are passed through as is.
     :param type: The ArtifactType to use (ARTIFACT_IMAGE, ARTIFACT_MASK, or ARTIFACT_DEPTH).
+    :param encoding: Lossless transport for the pixels. 'png' is smallest on the wire,
+        'ppm' and 'raw' (an uint8 tensor) take next to no time to encode but are
+        several times larger.
     """
-    return generation.Prompt(artifact=generation.Artifact(
-        type=type, 
-        binary=image_to_png_bytes(image)
-    ))
+    if isinstance(image, bytes):
+        return generation.Prompt(artifact=generation.Artifact(type=type, binary=image))
+
+    # hand out a copy so callers can't modify the cached message
+    prompt = generation.Prompt()
+    prompt.CopyFrom(_cached_image_prompt(_ImagePromptKey(image, type, encoding)))
+    return prompt
+
+class _ImagePromptKey:
+    """
+    Cache key for image_to_prompt which compares by a digest of everything the encoders
+    read, while carrying the image itself so a miss encodes the caller's original.
+    """
+    __slots__ = ('image', '_key')
+
+    def __init__(self, image: Image.Image, type: generation.ArtifactType, encoding: str):
+        digest = hashlib.blake2b(image.tobytes(), digest_size=32)
+        if image.mode in ('P', 'PA'):
+            digest.update(bytes(image.getpalette() or ()))
+        for name in ('dpi', 'exif', 'icc_profile', 'transparency'):
+            digest.update(repr(image.info.get(name)).encode())
+        self.image = image
+        self._key = (type, encoding, image.mode, image.size, digest.digest())
+
+    def __eq__(self, other) -> bool:
+        return self._key == other._key
+
+    def __hash__(self) -> int:
+        return hash(self._key)
+
+@functools.lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def _cached_image_prompt(key: _ImagePromptKey) -> generation.Prompt:
+    # init images and masks are typically reused across every frame of an animation
+    type, encoding = key._key[:2]
+    prompt = _encode_image_prompt(key.image, type, encoding)
+    key.image = None    # the cache keeps the key, don't let it pin the image too
+    return prompt
+
+def _encode_image_prompt(image: Image.Image, type: generation.ArtifactType, encoding: str) -> generation.Prompt:
+    if encoding == 'png':
+        return generation.Prompt(artifact=generation.Artifact(type=type, binary=image_to_png_bytes(image)))
+    elif encoding == 'ppm':
+        if image.mode not in ('1', 'L', 'I', 'RGB'):
+            image = image.convert('L' if image.mode == 'LA' else 'RGB')
+        buf = io.BytesIO()
+        image.save(buf, format="PPM")
+        return generation.Prompt(artifact=generation.Artifact(type=type, mime="image/x-portable-anymap", binary=buf.getvalue()))
+    elif encoding == 'raw':
+        if image.mode not in ('L', 'RGB', 'RGBA'):
+            image = image.convert('RGB')
+        artifact = generation.Artifact(type=type)
+        artifact.tensor.dtype = _tensor_dtype_enum().values_by_name['DT_UINT8'].number
+        artifact.tensor.shape.extend([image.height, image.width, len(image.getbands())])
+        artifact.tensor.data = image.tobytes()
+        return generation.Prompt(artifact=artifact)
+    raise ValueError(f"invalid image encoding: {encoding}")
+
+def _open_and_show(binary: bytes, path: str, verbose: bool):
+    try:
+        if verbose:
+            logger.info(f"opening {path}")
+        img = Image.open(io.BytesIO(binary))
+        img.show()
+    except Exception as e:
+        logger.warning(f"failed to open {path}: {e}")
 
 def open_images(
     images: Union[
@@ -326,30 +496,57 @@ def open_images(
         Generator[Tuple[str, generation.Artifact], None, None],
     ],
     verbose: bool = False,
+    show: bool = True,
 ) -> Generator[Tuple[str, generation.Artifact], None, None]:
     """
     Open the images from the filenames and Artifacts tuples.
     :param images: The tuples of Artifacts and associated images to open.
+    :param show: Whether to open the images in a viewer, done in the background.
     :return:  A Generator of tuples of image filenames and Artifacts, intended
      for passthrough.
     """
     for path, artifact in images:
-        if artifact.type == generation.ARTIFACT_IMAGE:
-            if verbose:
-                logger.info(f"opening {path}")
-            img = Image.open(io.BytesIO(artifact.binary))
-            img.show()
+        if show and artifact.type == generation.ARTIFACT_IMAGE:
+            _image_open_pool.submit(_open_and_show, artifact.binary, path, verbose)
         yield (path, artifact)
 
-def tensor_to_prompt(tensor: 'tensors_pb.Tensor') -> generation.Prompt:
+def tensor_to_image(tensor: 'tensors_pb.Tensor') -> Image.Image:
+    """
+    Create an image from an uncompressed uint8 tensor without a decode pass.
+    :param tensor: The tensor, shaped (height, width) or (height, width, channels).
+    """
+    dtype_enum = _tensor_dtype_enum()
+    if tensor.dtype != dtype_enum.values_by_name['DT_UINT8'].number:
+        dtype = dtype_enum.values_by_number.get(tensor.dtype)
+        raise ValueError(f"Unsupported image tensor dtype {dtype.name if dtype else tensor.dtype}")
+    shape = list(tensor.shape)
+    channels = shape[2] if len(shape) == 3 else 1
+    mode = {1: 'L', 3: 'RGB', 4: 'RGBA'}.get(channels)
+    if mode is None or len(shape) not in (2, 3):
+        raise ValueError(f"Unsupported image tensor shape {shape}")
+    if len(tensor.data) != shape[0] * shape[1] * channels:
+        raise ValueError(f"Image tensor data has {len(tensor.data)} bytes, expected {shape[0] * shape[1] * channels} for shape {shape}")
+    return Image.frombuffer(mode, (shape[1], shape[0]), tensor.data, 'raw', mode, 0, 1)
+
+def tensor_to_prompt(tensor: Union['tensors_pb.Tensor', 'np.ndarray']) -> generation.Prompt:
     """
     Create Prompt message type from a tensor.
-    :param tensor: The tensor.    
+    :param tensor: The tensor, or a numpy array to pack into one.    
     """
-    return generation.Prompt(artifact=generation.Artifact(
-        type=generation.ARTIFACT_TENSOR, 
-        tensor=tensor
-    ))
+    if hasattr(tensor, 'SerializeToString'):
+        return generation.Prompt(artifact=generation.Artifact(
+            type=generation.ARTIFACT_TENSOR, 
+            tensor=tensor
+        ))
+
+    artifact = generation.Artifact(type=generation.ARTIFACT_TENSOR)
+    dtype_name = next((name for name, np_name in TENSOR_DTYPES.items() if np_name == tensor.dtype.name), None)
+    if dtype_name is None:
+        raise ValueError(f"Unsupported tensor dtype {tensor.dtype}")
+    artifact.tensor.dtype = _tensor_dtype_enum().values_by_name[dtype_name].number
+    artifact.tensor.shape.extend(tensor.shape)
+    artifact.tensor.data = tensor.tobytes()
+    return generation.Prompt(artifact=artifact)
 
 def truncate_fit(prefix: str, prompt: str, ext: str, ts: int, idx: int, max: int) -> str:
     """
@@ -1,8 +1,9 @@
+import os
 import pytest
 
 from pathlib import Path
 
-from stability_sdk.animation import Animator, AnimationArgs
+from stability_sdk.animation import Animator, AnimationArgs, link_or_copy
 from stability_sdk.api import Context
 
 from .test_api import MockStub
@@ -71,4 +72,25 @@ def test_init_image_from_input(impath):
     animator.load_init_image(impath)
     assert len(animator.prior_frames) == 1
     animator.set_cadence_mode(True)
-    assert len(animator.prior_frames) == 2
\ No newline at end of file
+    assert len(animator.prior_frames) == 2
+
+def test_link_or_copy(tmp_path):
+    src, dst = tmp_path / "frame_00000.png", tmp_path / "out.png"
+    src.write_bytes(b"first")
+    dst.write_bytes(b"stale")
+    link_or_copy(str(src), str(dst))
+    assert dst.read_bytes() == b"first"
+    assert os.path.samefile(src, dst)
+    link_or_copy(str(src), str(src))
+    assert src.read_bytes() == b"first"
+
+def test_link_or_copy_fallback(tmp_path, monkeypatch):
+    def no_link(src, dst):
+        raise OSError("cross-device link")
+    monkeypatch.setattr(os, "link", no_link)
+    src, dst = tmp_path / "frame_00000.png", tmp_path / "out.png"
+    src.write_bytes(b"first")
+    dst.write_bytes(b"stale")
+    link_or_copy(str(src), str(dst))
+    assert dst.read_bytes() == b"first"
+    assert not os.path.samefile(src, dst)
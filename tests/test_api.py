@@ -1,11 +1,14 @@
+import asyncio
+import grpc
 import io
 import numpy as np
+import pytest
 from PIL import Image
 from typing import Generator
 
 import stability_sdk.matrix as matrix
 from stability_sdk import utils
-from stability_sdk.api import Context, generation
+from stability_sdk.api import Context, Endpoint, generation
 
 def _artifact_from_image(image: Image.Image) -> generation.Artifact:
     binary = utils.image_to_png_bytes(image)            
@@ -36,8 +39,12 @@ class MockStub:
 
     def Generate(self, request: generation.Request, **kwargs) -> Generator[generation.Answer, None, None]:
         if request.HasField("image"):
-            image = _rand_image(request.image.width or 512, request.image.height or 512)
-            yield generation.Answer(artifacts=[_artifact_from_image(image)])
+            seeds = list(request.image.seed)
+            for i in range(max(1, request.image.samples)):
+                image = _rand_image(request.image.width or 512, request.image.height or 512)
+                artifact = _artifact_from_image(image)
+                artifact.seed = seeds[i] if i < len(seeds) else 0
+                yield generation.Answer(artifacts=[artifact])
 
         elif request.HasField("interpolate"):
             assert len(request.prompt) == 2
@@ -88,6 +95,14 @@ class MockStub:
                         artifact.type = generation.ARTIFACT_MASK
                         yield generation.Answer(artifacts=[artifact])
 
+class RecordingStub(MockStub):
+    def __init__(self, calls: list):
+        self.calls = calls
+
+    def Generate(self, request: generation.Request, **kwargs) -> Generator[generation.Answer, None, None]:
+        self.calls.append((self, request, kwargs))
+        return super().Generate(request, **kwargs)
+
 def test_api_generate():
     api = Context(stub=MockStub())
     width, height = 512, 768
@@ -99,6 +114,126 @@ def test_api_generate():
     assert isinstance(image, Image.Image)
     assert image.size == (width, height)
 
+def test_api_generate_async():
+    api = Context(stub=MockStub())
+    futures = [api.generate_async(["foo bar"], [1.0], width=512, height=512, seed=seed) for seed in (1, 2, 3)]
+    for future in futures:
+        results = future.result()
+        assert len(results[generation.ARTIFACT_IMAGE]) == 1
+        assert results[generation.ARTIFACT_IMAGE][0].size == (512, 512)
+
+def test_api_generate_batching():
+    calls = []
+    api = Context(stub=RecordingStub(calls))
+    api._dynamic_batching = True
+    api._batcher._window = 0.5   # generous so all three calls land in one batch
+    futures = [api.generate_async(["foo bar"], [1.0], width=512, height=512, seed=seed) for seed in (1, 2, 3)]
+    for future in futures:
+        results = future.result()
+        assert len(results[generation.ARTIFACT_IMAGE]) == 1
+    assert len(calls) == 1
+    _, request, _ = calls[0]
+    assert request.image.samples == 3
+    assert sorted(request.image.seed) == [1, 2, 3]
+
+def test_api_generate_batching_missing_sample():
+    class DroppingStub(MockStub):
+        def Generate(self, request, **kwargs):
+            # one solid image per seed, except seed 3 which the server drops
+            for seed in request.image.seed:
+                if seed != 3:
+                    artifact = _artifact_from_image(Image.new("RGB", (64, 64), (seed, 0, 0)))
+                    artifact.seed = seed
+                    yield generation.Answer(artifacts=[artifact])
+
+    api = Context(stub=DroppingStub())
+    api._dynamic_batching = True
+    api._batcher._window = 0.5
+    futures = {seed: api.generate_async(["foo bar"], [1.0], width=64, height=64, seed=seed) for seed in (1, 2, 3)}
+    for seed in (1, 2):
+        images = futures[seed].result()[generation.ARTIFACT_IMAGE]
+        assert len(images) == 1 and images[0].getpixel((0, 0))[0] == seed
+    with pytest.raises(RuntimeError, match="seed 3"):
+        futures[3].result()
+
+def test_api_generate_compression():
+    calls = []
+    api = Context(stub=RecordingStub(calls))
+    init_image = _rand_image(64, 64)
+    api.generate(["foo bar"], [1.0], width=64, height=64)
+    api.generate(["foo bar"], [1.0], width=64, height=64, init_image=init_image)
+    for encoding in ('ppm', 'raw'):
+        api._image_encoding = encoding
+        api.generate(["foo bar"], [1.0], width=64, height=64, init_image=init_image)
+    assert [kwargs["compression"] for _, _, kwargs in calls] == [None, None, grpc.Compression.Gzip, grpc.Compression.Gzip]
+
+def test_api_generate_coroutine():
+    api = Context(stub=MockStub())
+    async def run():
+        return await asyncio.gather(*[api.agenerate(["foo bar"], [1.0], width=512, height=512, seed=seed) for seed in (1, 2, 3)])
+    for results in asyncio.run(run()):
+        assert len(results[generation.ARTIFACT_IMAGE]) == 1
+        assert results[generation.ARTIFACT_IMAGE][0].size == (512, 512)
+
+def test_api_generate_coroutine_batching():
+    calls = []
+    api = Context(stub=RecordingStub(calls))
+    api._dynamic_batching = True
+    api._batcher._max_batch_size = 2
+    api._batcher._window = 0.5
+    async def run():
+        return await asyncio.gather(*[api.agenerate(["foo bar"], [1.0], width=64, height=64, seed=seed) for seed in (1, 2, 3)])
+    for results in asyncio.run(run()):
+        assert len(results[generation.ARTIFACT_IMAGE]) == 1
+    assert len(calls) == 2
+
+def test_api_generate_coroutine_validates():
+    api = Context(stub=MockStub())
+    mask = _rand_image(512, 512).convert("L")
+    with pytest.raises(ValueError, match="init_image"):
+        asyncio.run(api.agenerate(["foo bar"], [1.0], mask=mask))
+
+def test_api_generate_raw_image_prompts():
+    api = Context(stub=MockStub())
+    api._image_encoding = 'raw'
+    init_image = _rand_image(512, 512)
+    request = api.generate(["foo bar"], [1.0], init_image=init_image, return_request=True)
+    assert request.prompt[1].artifact.HasField("tensor")
+    assert utils.tensor_to_image(request.prompt[1].artifact.tensor).tobytes() == init_image.tobytes()
+
+def test_api_generate_reuses_image_prompts():
+    api = Context(stub=MockStub())
+    utils.clear_prompt_cache()
+    init_image = _rand_image(512, 512)
+    mask = _rand_image(512, 512).convert("L")
+    first = api.generate(["foo bar"], [1.0], init_image=init_image, mask=mask, return_request=True)
+    second = api.generate(["foo bar"], [1.0], init_image=init_image.copy(), mask=mask, return_request=True)
+    assert utils._cached_image_prompt.cache_info().currsize == 2
+    assert first.prompt[1] == second.prompt[1]
+    assert first.prompt[2] == second.prompt[2]
+
+def test_api_generate_round_robin():
+    calls = []
+    stubs = [RecordingStub(calls), RecordingStub(calls)]
+    api = Context(stub=stubs[0])
+    api._generate = Endpoint(stubs[0], api._generate.engine_id, stubs)
+    for _ in range(4):
+        api.generate(["foo bar"], [1.0], width=64, height=64)
+    assert [stub for stub, _, _ in calls] == [stubs[0], stubs[1], stubs[0], stubs[1]]
+
+def test_api_generate_tensor_image():
+    class TensorStub(MockStub):
+        def Generate(self, request, **kwargs):
+            self.image = _rand_image(64, 64)
+            yield generation.Answer(artifacts=[utils.image_to_prompt(self.image, encoding='raw').artifact])
+
+    stub = TensorStub()
+    api = Context(stub=stub)
+    results = api.generate(["foo bar"], [1.0], width=64, height=64)
+    image = results[generation.ARTIFACT_IMAGE][0]
+    assert isinstance(image, Image.Image)
+    assert image.tobytes() == stub.image.tobytes()
+
 def test_api_inpaint():
     api = Context(stub=MockStub())
     width, height = 512, 768
@@ -121,6 +256,19 @@ def test_api_interpolate():
     for image in results:
         assert isinstance(image, Image.Image)
         assert image.size == (width, height)
+    results = api.interpolate([image_a, image_b], [0.0, 0.5, 1.0])
+    assert results[0] is image_a and results[2] is image_b
+
+def test_api_interpolate_rife():
+    api = Context(stub=MockStub())
+    width, height = 512, 768
+    image_a = _rand_image(width, height)
+    image_b = _rand_image(width, height)
+    results = api.interpolate([image_a, image_b], [0.3, 0.5, 0.6], generation.INTERPOLATE_RIFE)
+    assert len(results) == 3
+    for image in results:
+        assert isinstance(image, Image.Image)
+        assert image.size == (width, height)
 
 def test_api_transform_and_generate():
     api = Context(stub=MockStub())
@@ -148,6 +296,23 @@ def test_api_transform_camera_pose():
     assert isinstance(images[0], Image.Image)
     assert isinstance(masks[0], Image.Image)
 
+def test_api_transform_chain():
+    api = Context(stub=MockStub())
+    image = _rand_image()
+    params = [utils.color_adjust_transform(brightness=1.1), utils.color_adjust_transform(contrast=1.1)]
+    images, masks = api.transform([image, image], params, extras={"test": True})
+    assert len(images) == 2 and not masks
+    assert isinstance(images[0], Image.Image)
+
+def test_api_transform_chain_unchained():
+    api = Context(stub=MockStub())
+    api._debug_no_chains = True
+    image = _rand_image()
+    params = [utils.color_adjust_transform(brightness=1.1), utils.color_adjust_transform(contrast=1.1)]
+    images, masks = api.transform([image, image], params)
+    assert len(images) == 2 and not masks
+    assert all(isinstance(image, Image.Image) for image in images)
+
 def test_api_transform_color_adjust():
     api = Context(stub=MockStub())
     image = _rand_image()
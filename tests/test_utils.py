@@ -1,3 +1,5 @@
+import io
+import numpy as np
 import pytest
 
 from PIL import Image
@@ -10,8 +12,11 @@ from stability_sdk.utils import (
     COLOR_MATCH_MODES,
     GUIDANCE_PRESETS,
     SAMPLERS,
+    TransformOpBuilder,
+    _cached_image_prompt,
     artifact_type_to_string,
     border_mode_from_string,
+    clear_prompt_cache,
     color_adjust_transform,
     color_match_from_string,
     depth_calc_transform,
@@ -22,6 +27,8 @@ from stability_sdk.utils import (
     image_to_prompt,
     resample_transform,
     sampler_from_string,
+    tensor_to_image,
+    tensor_to_prompt,
     truncate_fit,
 )
 
@@ -126,11 +133,72 @@ def test_image_to_prompt(pil_image):
     assert isinstance(result, generation.Prompt)
     assert result.artifact.type == generation.ARTIFACT_IMAGE
 
+def test_image_to_prompt_bytes(pil_image):
+    binary = image_to_png_bytes(pil_image)
+    result = image_to_prompt(binary)
+    assert result.artifact.type == generation.ARTIFACT_IMAGE
+    assert result.artifact.binary == binary
+
+@pytest.mark.parametrize("encoding", ['png', 'ppm', 'raw'])
+def test_image_to_prompt_encoding(pil_image, encoding):
+    rgb = pil_image.convert('RGB')
+    result = image_to_prompt(rgb, encoding=encoding)
+    assert result.artifact.type == generation.ARTIFACT_IMAGE
+    if encoding == 'raw':
+        assert tensor_to_image(result.artifact.tensor).tobytes() == rgb.tobytes()
+    else:
+        assert Image.open(io.BytesIO(result.artifact.binary)).tobytes() == rgb.tobytes()
+
+def test_image_to_prompt_keeps_info(pil_image):
+    rgb = pil_image.convert('RGB')
+    clear_prompt_cache()
+    image_to_prompt(rgb)
+    rgb.info['dpi'] = (300, 300)
+    result = image_to_prompt(rgb)
+    dpi = Image.open(io.BytesIO(result.artifact.binary)).info['dpi']
+    assert tuple(round(v) for v in dpi) == (300, 300)
+
+def test_image_to_prompt_memoized(pil_image):
+    rgb = pil_image.convert('RGB')
+    clear_prompt_cache()
+    first = image_to_prompt(rgb)
+    first.artifact.binary = b''
+    second = image_to_prompt(rgb.copy())
+    assert second.artifact.binary == image_to_png_bytes(rgb)
+    assert second is not first
+    image_to_prompt(rgb.point(lambda v: 255 - v))
+    assert _cached_image_prompt.cache_info().currsize == 2
+
 def test_image_to_prompt_mask(pil_image):
     result = image_to_prompt(pil_image, type=generation.ARTIFACT_MASK)
     assert isinstance(result, generation.Prompt)
     assert result.artifact.type == generation.ARTIFACT_MASK
 
+@pytest.mark.parametrize("mode", ['1', 'L', 'LA', 'P', 'RGB', 'RGBA'])
+def test_image_to_prompt_ppm_modes(pil_image, mode):
+    image = pil_image.convert(mode)
+    result = image_to_prompt(image, encoding='ppm')
+    assert Image.open(io.BytesIO(result.artifact.binary)).size == image.size
+
+def test_tensor_to_image(pil_image):
+    rgb = pil_image.convert('RGB')
+    artifact = image_to_prompt(rgb, encoding='raw').artifact
+    result = tensor_to_image(artifact.tensor)
+    assert result.mode == 'RGB' and result.size == rgb.size
+    assert result.tobytes() == rgb.tobytes()
+
+def test_tensor_to_image_rejects_float():
+    artifact = tensor_to_prompt(np.zeros((4, 4, 3), dtype=np.float32)).artifact
+    with pytest.raises(ValueError, match="dtype"):
+        tensor_to_image(artifact.tensor)
+
+def test_tensor_to_prompt_ndarray():
+    array = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+    result = tensor_to_prompt(array)
+    assert result.artifact.type == generation.ARTIFACT_TENSOR
+    assert list(result.artifact.tensor.shape) == [2, 3, 4]
+    assert result.artifact.tensor.data == array.tobytes()
+
 
 #==============================================================================
 # Transform functions
@@ -151,6 +219,14 @@ def test_colormatch_invalid(pil_image):
             match_mode="not a real color match mode",
         )
 
+def test_transform_op_builder_color_adjust(pil_image):
+    builder = TransformOpBuilder()
+    op = builder.color_adjust(brightness=1.2, match_image=pil_image, match_mode='HSV')
+    assert op == color_adjust_transform(brightness=1.2, match_image=pil_image, match_mode='HSV')
+    op = builder.color_adjust(contrast=0.8)
+    assert op == color_adjust_transform(contrast=0.8)
+    assert not op.color_adjust.HasField("match_image")
+
 @pytest.mark.parametrize("border_mode", BORDER_MODES.keys())
 def test_resample_valid(border_mode):
     op = resample_transform(